@@ -1,9 +1,49 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
-from sklearn.preprocessing import MinMaxScaler
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import plotly.express as px
 
+STATE_ABBR_TO_FIPS = pd.Series({
+    'AL': '01', 'AK': '02', 'AZ': '04', 'AR': '05', 'CA': '06', 'CO': '08', 'CT': '09',
+    'DE': '10', 'FL': '12', 'GA': '13', 'HI': '15', 'ID': '16', 'IL': '17', 'IN': '18',
+    'IA': '19', 'KS': '20', 'KY': '21', 'LA': '22', 'ME': '23', 'MD': '24', 'MA': '25',
+    'MI': '26', 'MN': '27', 'MS': '28', 'MO': '29', 'MT': '30', 'NE': '31', 'NV': '32',
+    'NH': '33', 'NJ': '34', 'NM': '35', 'NY': '36', 'NC': '37', 'ND': '38', 'OH': '39',
+    'OK': '40', 'OR': '41', 'PA': '42', 'RI': '44', 'SC': '45', 'SD': '46', 'TN': '47',
+    'TX': '48', 'UT': '49', 'VT': '50', 'VA': '51', 'WA': '53', 'WV': '54', 'WI': '55',
+    'WY': '56'
+})
+
+STATE_FIPS_TO_NAME = pd.Series({
+    '01': 'Alabama', '02': 'Alaska', '04': 'Arizona', '05': 'Arkansas', '06': 'California',
+    '08': 'Colorado', '09': 'Connecticut', '10': 'Delaware', '12': 'Florida', '13': 'Georgia',
+    '15': 'Hawaii', '16': 'Idaho', '17': 'Illinois', '18': 'Indiana', '19': 'Iowa',
+    '20': 'Kansas', '21': 'Kentucky', '22': 'Louisiana', '23': 'Maine', '24': 'Maryland',
+    '25': 'Massachusetts', '26': 'Michigan', '27': 'Minnesota', '28': 'Mississippi', '29': 'Missouri',
+    '30': 'Montana', '31': 'Nebraska', '32': 'Nevada', '33': 'New Hampshire', '34': 'New Jersey',
+    '35': 'New Mexico', '36': 'New York', '37': 'North Carolina', '38': 'North Dakota', '39': 'Ohio',
+    '40': 'Oklahoma', '41': 'Oregon', '42': 'Pennsylvania', '44': 'Rhode Island', '45': 'South Carolina',
+    '46': 'South Dakota', '47': 'Tennessee', '48': 'Texas', '49': 'Utah', '50': 'Vermont',
+    '51': 'Virginia', '53': 'Washington', '54': 'West Virginia', '55': 'Wisconsin', '56': 'Wyoming'
+})
+
+STATE_NAME_TO_FIPS = pd.Series(STATE_FIPS_TO_NAME.index, index=STATE_FIPS_TO_NAME.values)
+
+COUNTIES_GEOJSON_URL = 'https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json'
+
+# One pooled session so repeat fetches reuse the TLS connection
+_SESSION = requests.Session()
+_SESSION.headers['Accept-Encoding'] = 'gzip, deflate'
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4, pool_maxsize=4,
+    max_retries=Retry(total=3, backoff_factor=0.3)
+))
+
 # Caching the data load to avoid re-fetching on every run
 @st.cache_data(ttl=3600)
 def load_census_data(api_key):
@@ -20,54 +60,103 @@ def load_census_data(api_key):
     }
     var_list = ",".join(variables.keys())
 
-    response = requests.get(
-        f"{BASE_URL}?get=NAME,{var_list}&for=county:*&key={api_key}"
+    response = _SESSION.get(
+        f"{BASE_URL}?get=NAME,{var_list}&for=county:*&key={api_key}",
+        timeout=(3, 30)
     )
     response.raise_for_status()
-    data = response.json()
+    data = orjson.loads(response.content)
 
-    columns = data[0]
-    rows = data[1:]
-    df = pd.DataFrame(rows, columns=columns)
+    # Rows come back as NAME, <variables...>, state, county
+    rows = np.array(data[1:], dtype=object)
+    block = rows[:, 1:-2]
+    # float32 is plenty for ~3200 counties feeding percentile ranks, and halves
+    # the footprint of the cached frame
+    numeric = pd.to_numeric(block.ravel(), errors='coerce').astype(np.float32).reshape(block.shape)
 
-    df = df.rename(columns=variables)
-    for col in variables.values():
-        df[col] = pd.to_numeric(df[col], errors='coerce')
+    df = pd.DataFrame(numeric, columns=list(variables.values()))
+    df.insert(0, "NAME", rows[:, 0])
+    df["state"] = rows[:, -2]
+    df["county"] = rows[:, -1]
 
     df["fips"] = df["state"] + df["county"]
-    df["homeownership_rate"] = df["owner_occupied_units"] / df["total_occupied_units"]
-    df["sf_ratio"] = (df["sf_detached"] + df["sf_attached"]) / df["total_housing_units"].replace(0, pd.NA)
+    # Zero denominators become NaN without going through an object-dtype replace
+    occupied = df["total_occupied_units"].to_numpy()
+    df["homeownership_rate"] = np.divide(
+        df["owner_occupied_units"].to_numpy(), occupied,
+        out=np.full_like(occupied, np.nan), where=occupied != 0
+    )
+    housing = df["total_housing_units"].to_numpy()
+    df["sf_ratio"] = np.divide(
+        (df["sf_detached"] + df["sf_attached"]).to_numpy(), housing,
+        out=np.full_like(housing, np.nan), where=housing != 0
+    )
 
     return df
 
-def id_to_fips(id_str):
-    state_abbr_to_fips = {
-        'AL': '01', 'AK': '02', 'AZ': '04', 'AR': '05', 'CA': '06', 'CO': '08', 'CT': '09',
-        'DE': '10', 'FL': '12', 'GA': '13', 'HI': '15', 'ID': '16', 'IL': '17', 'IN': '18',
-        'IA': '19', 'KS': '20', 'KY': '21', 'LA': '22', 'ME': '23', 'MD': '24', 'MA': '25',
-        'MI': '26', 'MN': '27', 'MS': '28', 'MO': '29', 'MT': '30', 'NE': '31', 'NV': '32',
-        'NH': '33', 'NJ': '34', 'NM': '35', 'NY': '36', 'NC': '37', 'ND': '38', 'OH': '39',
-        'OK': '40', 'OR': '41', 'PA': '42', 'RI': '44', 'SC': '45', 'SD': '46', 'TN': '47',
-        'TX': '48', 'UT': '49', 'VT': '50', 'VA': '51', 'WA': '53', 'WV': '54', 'WI': '55',
-        'WY': '56'
-    }
-    state_abbr, county_code = id_str.split("-")
-    return state_abbr_to_fips[state_abbr] + county_code.zfill(3)
+def id_to_fips(ids):
+    # "AL-001" -> "01001", vectorized over the whole ID column
+    parts = ids.str.split("-", n=1, expand=True)
+    return parts[0].map(STATE_ABBR_TO_FIPS) + parts[1].str.zfill(3)
 
 @st.cache_data(ttl=3600)
 def load_weather_data():
 
-    precip = pd.read_csv("avg_prec.csv")
-    temp = pd.read_csv("avg_temp.csv")
+    csv_options = dict(
+        engine="pyarrow",
+        usecols=["ID", "Value"],
+        dtype={"ID": "string[pyarrow]", "Value": np.float32}
+    )
+    precip = pd.read_csv("avg_prec.csv", **csv_options)
+    temp = pd.read_csv("avg_temp.csv", **csv_options)
 
-    precip["fips"] = precip["ID"].apply(id_to_fips)
-    temp["fips"] = temp["ID"].apply(id_to_fips)
+    precip["fips"] = id_to_fips(precip["ID"])
+    temp["fips"] = id_to_fips(temp["ID"])
 
-    precip = precip[["fips", "Value"]].rename(columns={"Value": "avg_precipitation"})
-    temp = temp[["fips", "Value"]].rename(columns={"Value": "avg_temperature"})
+    # Return fips-indexed Series so callers can attach them with .map. The
+    # temperature file repeats a few Wyoming rows, so keep the first of each.
+    precip = precip.drop_duplicates("fips").set_index("fips")["Value"]
+    temp = temp.drop_duplicates("fips").set_index("fips")["Value"]
 
     return precip, temp
 
+@st.cache_data(ttl=86400)
+def load_counties_geojson():
+    response = _SESSION.get(COUNTIES_GEOJSON_URL, timeout=(3, 30))
+    response.raise_for_status()
+    return response.json()
+
+@st.cache_data(ttl=86400)
+def load_state_geojson(state_fips):
+    counties = load_counties_geojson()
+    return {
+        **counties,
+        "features": [f for f in counties["features"] if f["id"].startswith(state_fips)]
+    }
+
+def pct_rank_2d(M):
+    # Column-wise equivalent of Series.rank(pct=True): ties get their average
+    # rank, NaNs stay NaN and are left out of the denominator.
+    n = M.shape[0]
+    order = np.argsort(M, axis=0, kind="stable")
+    sorted_vals = np.take_along_axis(M, order, axis=0)
+    pos = np.arange(n)[:, None]
+
+    starts = np.ones(M.shape, dtype=bool)
+    starts[1:] = sorted_vals[1:] != sorted_vals[:-1]
+    ends = np.ones(M.shape, dtype=bool)
+    ends[:-1] = starts[1:]
+
+    first = np.maximum.accumulate(np.where(starts, pos, 0), axis=0)
+    last = np.minimum.accumulate(np.where(ends, pos, n)[::-1], axis=0)[::-1]
+
+    ranks = np.empty(M.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1.0, axis=0)
+
+    valid = ~np.isnan(M)
+    ranks[~valid] = np.nan
+    return ranks / valid.sum(axis=0).astype(np.float64)
+
 def calculate_scores(df):
     # Fill missing weather values with median
     # df['avg_precipitation'] = df['avg_precipitation'].fillna(df['avg_precipitation'].median())
@@ -76,30 +165,57 @@ def calculate_scores(df):
     df["home_age"] = 2025 - df["median_year_built"]
     df["adj_population"] = df["total_population"] * df["sf_ratio"]
 
-    df["rank_income"] = df["median_household_income"].rank(pct=True)
-    df["rank_home_age"] = df["home_age"].rank(pct=True)
-    df["rank_population"] = df["total_population"].rank(pct=True)
-    df["rank_adj_population"] = df["adj_population"].rank(pct=True)
-    df["rank_homeownership"] = df["homeownership_rate"].rank(pct=True)
-    df['rank_avg_precipitation'] = df['avg_precipitation'].rank(pct=True)
-    df['rank_avg_temperature'] = df['avg_temperature'].rank(pct=True)
-    df["rank_sf_ratio"] = df["sf_ratio"].rank(pct=True)
-
-    df["pest_sales_score_raw"] = (
-        df["rank_home_age"] * 0.125 +
-        df["rank_avg_precipitation"] * 0.125 +
-        df["rank_avg_temperature"] * 0.125 +
-        df["rank_sf_ratio"] * 0.25 +
-        df["rank_income"] * 0.125 +
-        df["rank_adj_population"] * 0.50 +
-        df["rank_homeownership"] * 0.05
-    )
+    rank_columns = {
+        "median_household_income": "rank_income",
+        "home_age": "rank_home_age",
+        "total_population": "rank_population",
+        "adj_population": "rank_adj_population",
+        "homeownership_rate": "rank_homeownership",
+        "avg_precipitation": "rank_avg_precipitation",
+        "avg_temperature": "rank_avg_temperature",
+        "sf_ratio": "rank_sf_ratio"
+    }
+    ranks = pct_rank_2d(df[list(rank_columns)].to_numpy(dtype=np.float64))
+    df[list(rank_columns.values())] = ranks
+
+    score_weights = {
+        "rank_home_age": 0.125,
+        "rank_avg_precipitation": 0.125,
+        "rank_avg_temperature": 0.125,
+        "rank_sf_ratio": 0.25,
+        "rank_income": 0.125,
+        "rank_adj_population": 0.50,
+        "rank_homeownership": 0.05
+    }
+    weights = np.array(list(score_weights.values()), dtype=np.float64)
+    df["pest_sales_score_raw"] = df[list(score_weights)].to_numpy(dtype=np.float64) @ weights
 
-    scaler = MinMaxScaler()
-    df["pest_sales_score"] = scaler.fit_transform(df[["pest_sales_score_raw"]])
+    raw = df["pest_sales_score_raw"]
+    score_range = raw.max() - raw.min()
+    df["pest_sales_score"] = 0.0 if score_range == 0 else (raw - raw.min()) / score_range
 
     return df
 
+# Caching the finished frame so widget reruns skip the merge and scoring
+@st.cache_data(ttl=3600)
+def build_scored_frame(api_key):
+    # The Census call waits on the network and the weather CSVs on disk, so
+    # let them overlap
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        census_future = executor.submit(load_census_data, api_key)
+        weather_future = executor.submit(load_weather_data)
+        df = census_future.result()
+        precip, temp = weather_future.result()
+
+    df["avg_precipitation"] = df["fips"].map(precip)
+    df["avg_temperature"] = df["fips"].map(temp)
+
+    # Create a new column for full state names in df:
+    df['state_name'] = df['state'].map(STATE_FIPS_TO_NAME).astype('category')
+    df['state'] = df['state'].astype('category')
+
+    return calculate_scores(df)
+
 def main():
     st.title("Pest Sales Potential Dashboard")
     st.markdown("""
@@ -117,37 +233,13 @@ def main():
         st.warning("Please enter a Census API key to proceed.")
         return
 
-    with st.spinner("Loading Census data..."):
-        df = load_census_data(API_KEY)
-
-    with st.spinner("Loading weather data..."):
-        precip, temp = load_weather_data()
-
-    df = df.merge(precip, on="fips", how="left")
-    df = df.merge(temp, on="fips", how="left")
-
-    df = calculate_scores(df)
+    with st.spinner("Loading Census and weather data..."):
+        df = build_scored_frame(API_KEY)
 
 
     # Filter by state
-    state_fips_to_name = {
-        '01': 'Alabama', '02': 'Alaska', '04': 'Arizona', '05': 'Arkansas', '06': 'California',
-        '08': 'Colorado', '09': 'Connecticut', '10': 'Delaware', '12': 'Florida', '13': 'Georgia',
-        '15': 'Hawaii', '16': 'Idaho', '17': 'Illinois', '18': 'Indiana', '19': 'Iowa',
-        '20': 'Kansas', '21': 'Kentucky', '22': 'Louisiana', '23': 'Maine', '24': 'Maryland',
-        '25': 'Massachusetts', '26': 'Michigan', '27': 'Minnesota', '28': 'Mississippi', '29': 'Missouri',
-        '30': 'Montana', '31': 'Nebraska', '32': 'Nevada', '33': 'New Hampshire', '34': 'New Jersey',
-        '35': 'New Mexico', '36': 'New York', '37': 'North Carolina', '38': 'North Dakota', '39': 'Ohio',
-        '40': 'Oklahoma', '41': 'Oregon', '42': 'Pennsylvania', '44': 'Rhode Island', '45': 'South Carolina',
-        '46': 'South Dakota', '47': 'Tennessee', '48': 'Texas', '49': 'Utah', '50': 'Vermont',
-        '51': 'Virginia', '53': 'Washington', '54': 'West Virginia', '55': 'Wisconsin', '56': 'Wyoming'
-    }
-
-    # Create a new column for full state names in df:
-    df['state_name'] = df['state'].map(state_fips_to_name)
-
     # Add an "All States" option
-    state_options = ['All States'] + sorted(df['state_name'].dropna().unique().tolist())
+    state_options = ['All States'] + df['state_name'].cat.categories.tolist()
 
     selected_state = st.selectbox("Filter by State", options=state_options, index=0)
 
@@ -159,18 +251,21 @@ def main():
 
     st.subheader(f"Sales Potential for {selected_state}")
 
-    st.dataframe(filtered_df[['NAME', 'median_household_income', 'home_age', 'sf_ratio', 'pest_sales_score']].sort_values('pest_sales_score', ascending=False).head(10))
+    st.dataframe(filtered_df.nlargest(10, 'pest_sales_score').loc[:, ['NAME', 'median_household_income', 'home_age', 'sf_ratio', 'pest_sales_score']])
 
     # Plot map
-    geojson_url = 'https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json'
-
-    fig = px.choropleth(
-        filtered_df,
-        geojson=geojson_url,
+    # Only hand plotly the polygons it will actually draw
+    with st.spinner("Loading county boundaries..."):
+        if selected_state != 'All States':
+            counties = load_state_geojson(STATE_NAME_TO_FIPS[selected_state])
+        else:
+            counties = load_counties_geojson()
+
+    map_options = dict(
+        geojson=counties,
         locations='fips',
         color='pest_sales_score',
         color_continuous_scale='RdYlGn',
-        scope='usa',
         labels={'pest_sales_score': 'Sales Potential'},
         hover_name='NAME',
         hover_data={
@@ -182,6 +277,19 @@ def main():
         title=f'Predicted Pest Sales Potential by County in {selected_state}'
     )
 
+    # A single state is only a few dozen polygons, which the SVG map handles
+    # fine; the full ~3200 counties render much faster on the WebGL tile map
+    if selected_state != 'All States':
+        fig = px.choropleth(filtered_df, scope='usa', **map_options)
+    else:
+        fig = px.choropleth_map(
+            filtered_df,
+            map_style='carto-positron',
+            zoom=3,
+            center={'lat': 37.0, 'lon': -95.7},
+            **map_options
+        )
+
     fig.update_layout(margin={"r":0,"t":50,"l":0,"b":0})
     st.plotly_chart(fig, use_container_width=True)
 